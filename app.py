@@ -1,90 +1,214 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow.feather as feather
 from src.processors.data_merger import get_merged_data
 from src.importers.data_importer import import_data_from_files
-from src.utils.config import UI_CONFIG
+from src.utils.config import UI_CONFIG, DATABASE_PATH, PLAN_DATA_PATH
 from src.database.connection import get_db_connection
 import os
+import threading
+from contextlib import closing
 
 # --- ページ設定 ---
 st.set_page_config(layout="wide", page_title=UI_CONFIG['title'])
 
 # --- データ取得 ---
+def get_db_mtime():
+    """
+    DBファイルの最終更新時刻を返す。キャッシュの無効化キーとして使う。
+    WALモードでは更新がまず -wal ファイルに書き込まれるため、両方の時刻を見る。
+    """
+    paths = [DATABASE_PATH, DATABASE_PATH + '-wal']
+    return max((os.path.getmtime(p) for p in paths if os.path.exists(p)), default=0.0)
+
 @st.cache_data(ttl=600) # 10分間キャッシュ
-def get_completion_history():
-    """完了履歴テーブルをDBから読み込む"""
+def get_compliance_counts(db_mtime, period_starts):
+    """
+    各期間の開始日時以降に完了したオーダーについて、(遵守件数, 完了件数) をDB側で集計して返す。
+    遵守判定は completion_history の生成カラム '遵守' を使い、完了日のインデックスで絞り込む。
+    完了履歴が1件もない場合は None を返す。
+    db_mtime はキャッシュキーとしてのみ使い、DBが更新されると自動的に再集計される。
+    """
     try:
-        conn = get_db_connection()
-        df = pd.read_sql_query("SELECT * FROM completion_history", conn)
-        conn.close()
-        return df
+        with closing(get_db_connection()) as conn:
+            if conn.execute("SELECT 1 FROM completion_history LIMIT 1").fetchone() is None:
+                return None
+            return [
+                conn.execute(
+                    'SELECT COALESCE(SUM("遵守"), 0), COUNT(*) FROM completion_history WHERE "完了日" >= ?',
+                    (period_start,)
+                ).fetchone()
+                for period_start in period_starts
+            ]
     except Exception as e:
-        # テーブルがない場合も空のDataFrameを返す
+        # テーブルがない場合も「履歴なし」として扱う
         print(f"履歴テーブルの読み込みに失敗: {e}")
-        return pd.DataFrame(columns=['子指図番号', '完了日', '基準計画終了日'])
+        return None
 
 # --- UIコンポーネント ---
 def display_compliance_dashboard():
     """遵守率ダッシュボードを表示する"""
     st.header("📈 遵守率ダッシュボード")
 
-    history_df = get_completion_history()
+    # 期間の開始日は日付単位で求める（現在時刻を含めると、開始日当日の完了分が除外されてしまう）
+    today = pd.Timestamp.now().normalize()
+    start_of_week = today - pd.Timedelta(days=today.dayofweek)
+    start_of_month = today.replace(day=1)
+    periods = [('今週', start_of_week), ('今月', start_of_month)]
+
+    # 完了日はDBに 'YYYY-MM-DD HH:MM:SS' 形式で保存されているため、同じ形式で比較する
+    counts = get_compliance_counts(
+        get_db_mtime(),
+        tuple(period_start.strftime('%Y-%m-%d %H:%M:%S') for _, period_start in periods)
+    )
 
-    if history_df.empty:
+    if counts is None:
         st.warning("完了履歴データがまだありません。")
         return
 
-    history_df['完了日'] = pd.to_datetime(history_df['完了日'])
-    history_df['基準計画終了日'] = pd.to_datetime(history_df['基準計画終了日'])
+    for (period_label, _), (compliant_count, completed_count) in zip(periods, counts):
+        if completed_count:
+            st.metric(
+                label=f"{period_label}の遵守率",
+                value=f"{compliant_count / completed_count * 100:.1f}%",
+                delta=f"{compliant_count}件 / {completed_count}件"
+            )
+        else:
+            st.metric(label=f"{period_label}の遵守率", value="N/A", delta=f"{period_label}の完成実績なし")
 
-    # 遵守状況を計算
-    history_df['遵守'] = history_df['完了日'] <= history_df['基準計画終了日']
+# Excel列幅の計測に使う行数（この行数を超えるデータは先頭行のみで計測する）
+EXCEL_WIDTH_SAMPLE_THRESHOLD = 10000
+EXCEL_WIDTH_SAMPLE_ROWS = 500
 
-    today = pd.Timestamp.now()
+# 渡されるのは load_plan_data が共有する（データ更新まで変化しない）DataFrameのため、
+# 内容全体をハッシュせずidで識別する。データ更新時には st.cache_data.clear() で破棄される。
+@st.cache_data(hash_funcs={pd.DataFrame: id})
+def to_excel(df):
+    import io
+    import xlsxwriter
+    output = io.BytesIO()
+    sheet_name = '生産計画データ'
+    # constant_memoryモードで1行ずつ書き出し、ブック全体をメモリに保持しない
+    # (pandasのto_excelは列単位でセルを書き込むため、このモードでは使えない)
+    workbook = xlsxwriter.Workbook(output, {
+        'constant_memory': True,
+        'strings_to_urls': False,
+        'strings_to_formulas': False,
+        'default_date_format': 'yyyy-mm-dd',
+    })
+    worksheet = workbook.add_worksheet(sheet_name)
 
-    # 週次遵守率
-    start_of_week = today - pd.to_timedelta(today.dayofweek, unit='d')
-    weekly_completed = history_df[history_df['完了日'] >= start_of_week]
+    # constant_memoryモードでは書き込み済みの行を後から変更できないため、
+    # 列幅・ウィンドウ枠の固定・オートフィルターはデータより先に設定する
+    # 列幅を自動調整
+    # 大量データでは先頭行のみを計測する（同一フォーマットのデータが並ぶため、最長値はほぼ先頭付近に現れる）
+    sample = df.head(EXCEL_WIDTH_SAMPLE_ROWS) if len(df) > EXCEL_WIDTH_SAMPLE_THRESHOLD else df
+    value_lengths = sample.astype(str).apply(lambda s: s.str.len().max()).fillna(0)
+    for col_idx, column in enumerate(df.columns):
+        column_length = max(int(value_lengths[column]), len(str(column)))
+        worksheet.set_column(col_idx, col_idx, column_length)
+    worksheet.freeze_panes(1, 1)
+    worksheet.autofilter(0, 0, len(df), len(df.columns) - 1)
 
-    if not weekly_completed.empty:
-        weekly_rate = weekly_completed['遵守'].mean() * 100
-        st.metric(
-            label="今週の遵守率",
-            value=f"{weekly_rate:.1f}%",
-            delta=f"{weekly_completed['遵守'].sum()}件 / {len(weekly_completed)}件"
-        )
-    else:
-        st.metric(label="今週の遵守率", value="N/A", delta="今週の完成実績なし")
+    # ヘッダー行（pandasのto_excelと同じ書式）
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    worksheet.write_row(0, 0, [str(column) for column in df.columns], header_format)
 
-    # 月次遵守率
-    start_of_month = today.replace(day=1)
-    monthly_completed = history_df[history_df['完了日'] >= start_of_month]
-
-    if not monthly_completed.empty:
-        monthly_rate = monthly_completed['遵守'].mean() * 100
-        st.metric(
-            label="今月の遵守率",
-            value=f"{monthly_rate:.1f}%",
-            delta=f"{monthly_completed['遵守'].sum()}件 / {len(monthly_completed)}件"
-        )
-    else:
-        st.metric(label="今月の遵守率", value="N/A", delta="今月の完成実績なし")
+    # データ行（欠損値は空セルとして書き出す）
+    # 全体をobject型にコピーせず、欠損値を含むカラムだけをNoneに置き換える
+    values = df.assign(**{
+        column: df[column].astype(object).where(df[column].notna(), None)
+        for column in df.columns if df[column].hasnans
+    })
+    for row_idx, row in enumerate(values.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row_idx, 0, row)
 
-@st.cache_data
-def to_excel(df):
-    import io
-    output = io.BytesIO()
-    # xlsxwriter をエンジンとして指定
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='生産計画データ')
-        # 列幅を自動調整
-        for column in df:
-            column_length = max(df[column].astype(str).map(len).max(), len(column))
-            col_idx = df.columns.get_loc(column)
-            writer.sheets['生産計画データ'].set_column(col_idx, col_idx, column_length)
+    workbook.close()
     processed_data = output.getvalue()
     return processed_data
 
+# 絞り込みフィルターで使う日付カラム（表示用の文字列カラム → datetime変換後のカラム名）
+FILTER_DATE_COLUMNS = {'所要日': '所要日_dt', '子指図計画終了日': '計画終了日_dt'}
+
+def save_plan_data(df):
+    """
+    統合済みデータをFeatherファイルに書き出す（セッションにはパスのみを保持する）。
+    ファイルは全セッションで共有されるため、同じディレクトリの一時ファイルに書き込んでから置き換え、
+    他のセッションが書き込み途中のファイルを読み込まないようにする。
+    """
+    # 一時ファイル名はプロセス・スレッドごとに分け、同時に更新したセッション同士が衝突しないようにする
+    # （mkstemp は所有者のみ読み書き可能なファイルを作るため使わず、通常のumaskで作成させる）
+    tmp_path = f"{PLAN_DATA_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        df.reset_index(drop=True).to_feather(tmp_path)
+        os.replace(tmp_path, PLAN_DATA_PATH)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return PLAN_DATA_PATH
+
+@st.cache_resource
+def load_plan_data(path, file_mtime):
+    """
+    統合済みデータをFeatherファイルから読み込む。
+    cache_resource のため全セッションで同じDataFrameを共有する（呼び出し側で変更しないこと）。
+    file_mtime はキャッシュキーとしてのみ使い、ファイルが書き換えられると再読み込みされる。
+    """
+    return feather.read_table(path).to_pandas()
+
+# 以下のキャッシュはデータ更新時に clear() で破棄されるため、DataFrameはidで識別する（内容のハッシュ計算を避ける）
+@st.cache_resource(hash_funcs={pd.DataFrame: id})
+def build_filter_dates(df):
+    """フィルター用の日付カラムをデータごとに一度だけ変換する"""
+    return pd.DataFrame(
+        {dt_col: pd.to_datetime(df[col], errors='coerce') for col, dt_col in FILTER_DATE_COLUMNS.items()},
+        index=df.index
+    )
+
+@st.cache_resource(hash_funcs={pd.DataFrame: id})
+def build_date_index(df_dates):
+    """
+    フィルター用の日付カラムごとに、並べ替え順とソート済みの値を返す。
+    日付範囲の絞り込みを全件走査ではなく二分探索で行うために使う（NaTは末尾に並ぶ）。
+    """
+    date_index = {}
+    for col in df_dates.columns:
+        values = df_dates[col].to_numpy(dtype='datetime64[ns]')
+        order = np.argsort(values, kind='stable')
+        date_index[col] = (order, values[order])
+    return date_index
+
+def _date_range_mask(date_index, column, date_range, n_rows):
+    """日付範囲（両端を含む）に該当する行のブールマスクを searchsorted で求める"""
+    order, sorted_values = date_index[column]
+    lo = np.searchsorted(sorted_values, pd.Timestamp(date_range[0]).to_datetime64(), side='left')
+    hi = np.searchsorted(sorted_values, pd.Timestamp(date_range[1]).to_datetime64(), side='right')
+    mask = np.zeros(n_rows, dtype=bool)
+    mask[order[lo:hi]] = True
+    return mask
+
+# フィルター条件の組み合わせごとに結果が保存されるため、件数の上限を設けて古いものから破棄する
+@st.cache_data(hash_funcs={pd.DataFrame: id}, max_entries=32)
+def filter_df(df, df_dates, date_range, p_date_range, types, compliance):
+    """
+    フィルター条件に一致する行を返す。
+    全体のコピーは作らず、条件をまとめた単一のブールマスクで絞り込む。
+    """
+    date_index = build_date_index(df_dates)
+    mask = np.ones(len(df), dtype=bool)
+    if date_range is not None:
+        mask &= _date_range_mask(date_index, '所要日_dt', date_range, len(df))
+    if p_date_range is not None:
+        mask &= _date_range_mask(date_index, '計画終了日_dt', p_date_range, len(df))
+    # 全選択（初期値）のままのフィルターは絞り込みを行わない
+    # 日付範囲は全範囲でも日付なしの行を除外するため、常に適用する
+    if set(types) != set(df['生産タイプ'].cat.categories):
+        mask &= df['生産タイプ'].isin(types).to_numpy()
+    if set(compliance) != set(df['遵守状況'].cat.categories):
+        mask &= df['遵守状況'].isin(compliance).to_numpy()
+    return df[mask]
+
 # --- メインロジック ---
 
 # --- タイトル ---
@@ -94,41 +218,56 @@ st.caption("製造指図データ (ZP02) と部品構成データ (ZP51N) を統
 # --- セッションステートの初期化 ---
 if 'data_loaded' not in st.session_state:
     st.session_state.data_loaded = False
-    st.session_state.df = pd.DataFrame()
-    st.session_state.last_update_time = None
+    st.session_state.plan_path = None
 
 # --- サイドバー ---
 with st.sidebar:
     st.header("⚙️ 操作パネル")
     
     if st.button('🔄 データ更新', type="primary"):
-        with st.spinner('ステップ1/2: データファイルをインポートしています...'):
+        df = pd.DataFrame()
+        with st.status('データを更新しています...') as status:
+            st.write('ステップ1/2: データファイルをインポートしています...')
             import_success = import_data_from_files()
-        
-        if import_success:
-            st.toast("✅ ファイルのインポートが完了しました。")
-            with st.spinner('ステップ2/2: データを統合・整形しています...'):
+            if import_success:
+                st.write('✅ ファイルのインポートが完了しました。')
+                st.write('ステップ2/2: データを統合・整形しています...')
                 df = get_merged_data()
-                if not df.empty:
-                    st.session_state.df = df
-                    st.session_state.data_loaded = True
-                    st.session_state.last_update_time = pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')
-                    # キャッシュをクリアしてダッシュボードを強制的に更新
-                    st.cache_data.clear()
-                    st.success('データの更新が完了しました。')
-                else:
-                    st.error('データの統合に失敗しました。詳細はコンソールログを確認してください。')
-        else:
+            status.update(
+                label='データ更新処理が終了しました。',
+                state='complete' if not df.empty else 'error',
+                expanded=False
+            )
+
+        if not import_success:
             st.error('データファイルのインポートに失敗しました。詳細はコンソールログを確認してください。')
+        elif df.empty:
+            st.error('データの統合に失敗しました。詳細はコンソールログを確認してください。')
+        else:
+            try:
+                st.session_state.plan_path = save_plan_data(df)
+            except Exception as e:
+                print(f"統合データの保存中にエラーが発生しました: {e}")
+                st.error('統合データの保存に失敗しました。詳細はコンソールログを確認してください。')
+            else:
+                st.session_state.data_loaded = True
+                # キャッシュをクリアしてダッシュボードを強制的に更新
+                st.cache_data.clear()
+                st.cache_resource.clear()
+                st.success('データの更新が完了しました。')
 
     if st.session_state.data_loaded:
-        st.info(f"最終更新: {st.session_state.last_update_time}")
+        # 共有ファイルは他のセッションからも更新されるため、最終更新時刻はファイルの更新時刻から表示する
+        plan_mtime = os.path.getmtime(st.session_state.plan_path)
+        plan_df = load_plan_data(st.session_state.plan_path, plan_mtime)
+        st.info(f"最終更新: {pd.Timestamp.fromtimestamp(plan_mtime).strftime('%Y-%m-%d %H:%M:%S')}")
         display_compliance_dashboard()
         
-        excel_data = to_excel(st.session_state.df)
+        # ブックの作成はダウンロードボタンが押された時にだけ行う（再描画のたびに作成しない）
+        export_df = plan_df
         st.download_button(
             label="📥 Excel形式で全件ダウンロード",
-            data=excel_data,
+            data=lambda: to_excel(export_df),
             file_name=f"production_plan_{pd.Timestamp.now().strftime('%Y%m%d')}.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
@@ -137,7 +276,10 @@ with st.sidebar:
 if st.session_state.data_loaded:
     st.header("📊 統合データ一覧")
     
-    df_display = st.session_state.df.copy()
+    df = plan_df
+    df_dates = build_filter_dates(df)
+    date_range = None
+    p_date_range = None
 
     # --- フィルター機能 ---
     with st.expander("絞り込みフィルター", expanded=True):
@@ -145,39 +287,38 @@ if st.session_state.data_loaded:
         
         with col1:
             # 所要日フィルター
-            df_display['所要日_dt'] = pd.to_datetime(df_display['所要日'], errors='coerce')
-            min_date = df_display['所要日_dt'].min()
-            max_date = df_display['所要日_dt'].max()
+            min_date = df_dates['所要日_dt'].min()
+            max_date = df_dates['所要日_dt'].max()
             if pd.notna(min_date) and pd.notna(max_date):
-                date_range = st.date_input("所要日の範囲", value=(min_date, max_date), min_value=min_date, max_value=max_date, format="YYYY/MM/DD")
-                if len(date_range) == 2:
-                    df_display = df_display[df_display['所要日_dt'].between(pd.to_datetime(date_range[0]), pd.to_datetime(date_range[1]))]
+                selected_range = st.date_input("所要日の範囲", value=(min_date, max_date), min_value=min_date, max_value=max_date, format="YYYY/MM/DD")
+                if len(selected_range) == 2:
+                    date_range = tuple(selected_range)
             else:
                 st.info("所要日データがありません。")
 
         with col2:
             # 子指図計画終了日フィルター
-            df_display['計画終了日_dt'] = pd.to_datetime(df_display['子指図計画終了日'], errors='coerce')
-            min_p_date = df_display['計画終了日_dt'].min()
-            max_p_date = df_display['計画終了日_dt'].max()
+            min_p_date = df_dates['計画終了日_dt'].min()
+            max_p_date = df_dates['計画終了日_dt'].max()
             if pd.notna(min_p_date) and pd.notna(max_p_date):
-                p_date_range = st.date_input("子指図計画終了日の範囲", value=(min_p_date, max_p_date), min_value=min_p_date, max_value=max_p_date, format="YYYY/MM/DD")
-                if len(p_date_range) == 2:
-                    df_display = df_display[df_display['計画終了日_dt'].between(pd.to_datetime(p_date_range[0]), pd.to_datetime(p_date_range[1]))]
+                selected_p_range = st.date_input("子指図計画終了日の範囲", value=(min_p_date, max_p_date), min_value=min_p_date, max_value=max_p_date, format="YYYY/MM/DD")
+                if len(selected_p_range) == 2:
+                    p_date_range = tuple(selected_p_range)
             else:
                 st.info("計画終了日データがありません。")
 
         with col3:
             # 生産タイプフィルター
-            prod_types = sorted(df_display['生産タイプ'].dropna().unique())
+            # カテゴリ型のため、全件を走査せずにカテゴリ一覧をそのまま選択肢にする
+            prod_types = list(df['生産タイプ'].cat.categories)
             selected_types = st.multiselect("生産タイプ", options=prod_types, default=prod_types)
-            df_display = df_display[df_display['生産タイプ'].isin(selected_types)]
 
         with col4:
             # 遵守状況フィルター
-            compliance_status = sorted(df_display['遵守状況'].dropna().unique())
+            compliance_status = list(df['遵守状況'].cat.categories)
             selected_compliance = st.multiselect("遵守状況", options=compliance_status, default=compliance_status)
-            df_display = df_display[df_display['遵守状況'].isin(selected_compliance)]
+
+    df_display = filter_df(df, df_dates, date_range, p_date_range, selected_types, selected_compliance)
 
     # 表示するカラムの順番を定義
     display_columns = [
@@ -194,6 +335,6 @@ if st.session_state.data_loaded:
         use_container_width=True,
         hide_index=True
     )
-    st.info(f"全 {len(st.session_state.df)} 件中 {len(df_display)} 件を表示しています。")
+    st.info(f"全 {len(df)} 件中 {len(df_display)} 件を表示しています。")
 else:
     st.info('サイドバーの「データ更新」ボタンをクリックして、最新の生産計画データを表示してください。')
@@ -2,18 +2,21 @@ import sqlite3
 from sqlite3 import Connection
 import os
 
-from ..utils.config import DATABASE_PATH
+from ..utils.config import DATABASE_PATH, DATABASE_PRAGMAS
 
 def get_db_connection() -> Connection:
     """
     SQLiteデータベースへの接続を取得します。
     データベースファイルが存在しない場合は、新しく作成されます。
+    接続ごとに設定ファイルで定義されたPRAGMA（WALモード等）を適用します。
 
     Returns:
         Connection: sqlite3の接続オブジェクト
     """
     try:
         conn = sqlite3.connect(DATABASE_PATH)
+        for name, value in DATABASE_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name}={value}")
         # print(f"Successfully connected to database at {DATABASE_PATH}")
         return conn
     except sqlite3.Error as e:
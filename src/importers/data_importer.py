@@ -1,10 +1,24 @@
 import pandas as pd
 import sqlite3
 import os
+from contextlib import closing
+
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 
 from ..database.connection import get_db_connection
 from ..utils.config import LOCAL_DATA_PATHS, ENCODING, ZP02_COLUMNS, ZP51N_COLUMNS
 
+# 取込ファイルを分割して読み込むブロックサイズ（バイト）
+# ピークメモリをファイル全体ではなく分割単位に抑える
+IMPORT_BLOCK_SIZE = 16 << 20
+
+# 欠損値として扱う文字列（pandasの read_csv の既定の na_values と同じ）
+NULL_VALUES = [
+    '', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+    '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'
+]
+
 def import_data_from_files():
     """
     設定ファイルで定義されたパスからデータを読み込み、SQLiteデータベースにインポートする。
@@ -12,28 +26,16 @@ def import_data_from_files():
     print("データインポート処理を開始します...")
 
     try:
-        conn = get_db_connection()
-        print("データベース接続に成功しました。")
-
-        # ZP02データのインポート
-        _load_and_insert(
-            conn=conn,
-            file_path=LOCAL_DATA_PATHS['ZP02'],
-            table_name='zp02',
-            columns=ZP02_COLUMNS,
-            encoding=ENCODING['input']
-        )
+        # エラーで途中終了した場合も接続は必ず閉じる
+        with closing(get_db_connection()) as conn:
+            print("データベース接続に成功しました。")
 
-        # ZP51Nデータのインポート
-        _load_and_insert(
-            conn=conn,
-            file_path=LOCAL_DATA_PATHS['ZP51N'],
-            table_name='zp51n',
-            columns=ZP51N_COLUMNS,
-            encoding=ENCODING['input']
-        )
+            # ファイルは分割して読み込み、読み込んだ分から順に挿入する
+            # ZP02データのインポート
+            _insert_chunks(conn, _read_data_chunks(LOCAL_DATA_PATHS['ZP02'], ZP02_COLUMNS, ENCODING['input']), ZP02_COLUMNS, 'zp02')
 
-        conn.close()
+            # ZP51Nデータのインポート
+            _insert_chunks(conn, _read_data_chunks(LOCAL_DATA_PATHS['ZP51N'], ZP51N_COLUMNS, ENCODING['input']), ZP51N_COLUMNS, 'zp51n')
         print("データベース接続を閉じました。")
         print("データインポート処理が正常に完了しました。")
         return True
@@ -42,33 +44,80 @@ def import_data_from_files():
         print(f"データインポート中にエラーが発生しました: {e}")
         return False
 
-def _load_and_insert(conn: sqlite3.Connection, file_path: str, table_name: str, columns: list, encoding: str):
+def _read_data_chunks(file_path: str, columns: list, encoding: str):
     """
-    単一のファイルを読み込み、データベースのテーブルに挿入するヘルパー関数。
+    単一のデータファイルを分割して読み込み、DataFrameを順に返すジェネレータ。
     """
-    print(f"'{file_path}' から '{table_name}' テーブルへデータをインポート中...")
+    print(f"'{file_path}' を読み込み中...")
 
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"データファイルが見つかりません: {file_path}")
 
     try:
-        # タブ区切りのファイルを読み込む
-        df = pd.read_csv(
-            file_path,
-            sep='\t',
-            header=None,
-            names=columns,
+        yield from _read_with_pyarrow(file_path, columns, encoding)
+
+    except Exception as e:
+        print(f"'{file_path}' の処理中にエラーが発生しました: {e}")
+        raise
+
+def _read_with_pyarrow(file_path: str, columns: list, encoding: str):
+    """
+    pyarrowのストリーミングCSVリーダーでタブ区切りファイルをブロック単位に読み込むジェネレータ。
+    次のブロックの読み込みはバックグラウンドのスレッドで先行して行われ、挿入処理と並行する。
+    全カラムを文字列型に固定して型推論を省く。
+    列数が多すぎる行は警告を表示してスキップし、列数が足りない行はエラーにして取込を中止する
+    （行ごと捨てるとオーダーが欠落するため。取込はトランザクション内で行うため既存のテーブルは残る）。
+    """
+    def _handle_invalid_row(row):
+        if row.actual_columns > row.expected_columns:
+            print(f"'{file_path}' の{row.number}行目は列数が多すぎるためスキップします。")
+            return 'skip'
+        print(f"'{file_path}' の{row.number}行目は列数が不足しているため、取込を中止します。"
+              f"（{row.expected_columns}列中{row.actual_columns}列）")
+        return 'error'
+
+    reader = pa_csv.open_csv(
+        file_path,
+        read_options=pa_csv.ReadOptions(
             encoding=encoding,
-            dtype=str,  # 全てのカラムを文字列として読み込み、後の処理で型変換する
-            skiprows=1, # 先頭行（ヘッダー）をスキップする
-            on_bad_lines='warn' # 不正な行を警告として表示
+            column_names=columns,
+            skip_rows=1,  # 先頭行（ヘッダー）をスキップする
+            block_size=IMPORT_BLOCK_SIZE
+        ),
+        parse_options=pa_csv.ParseOptions(delimiter='\t', invalid_row_handler=_handle_invalid_row),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={column: pa.string() for column in columns},
+            # 空欄や 'NULL'・'None' などは欠損値として扱う（pandasの read_csv の既定と同じ）
+            null_values=NULL_VALUES,
+            strings_can_be_null=True
         )
+    )
+    for batch in reader:
+        yield batch.to_pandas(types_mapper=pd.ArrowDtype)
 
-        # データベースに書き込む
-        df.to_sql(table_name, conn, if_exists='replace', index=False)
+def _insert_chunks(conn: sqlite3.Connection, chunks, columns: list, table_name: str):
+    """
+    分割して読み込んだDataFrameを順にデータベースのテーブルに挿入するヘルパー関数。
+    """
+    print(f"'{table_name}' テーブルへデータをインポート中...")
 
-        print(f"'{table_name}' テーブルへのインポートが完了しました。{len(df)}件")
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    column_definitions = ', '.join(f'"{column}" TEXT' for column in columns)
+    placeholders = ', '.join('?' * len(columns))
+    insert_sql = f"INSERT INTO {table_name} ({column_list}) VALUES ({placeholders})"
+    row_count = 0
 
-    except Exception as e:
-        print(f"'{file_path}' の処理中にエラーが発生しました: {e}")
-        raise
+    # データベースに書き込む
+    # to_sqlを経由せず、テーブルの作り直しと各分割のexecutemanyによる挿入を1つのトランザクションで行う
+    # 読み込みの途中でエラーになった場合はロールバックされ、既存のテーブルはそのまま残る
+    with conn:
+        conn.execute("BEGIN")
+        conn.execute(f"DROP TABLE IF EXISTS {table_name}")
+        conn.execute(f"CREATE TABLE {table_name} ({column_definitions})")
+        for df in chunks:
+            # 欠損値はNULLとして挿入する
+            rows = zip(*(df[column].to_numpy(dtype=object, na_value=None) for column in columns))
+            conn.executemany(insert_sql, rows)
+            row_count += len(df)
+
+    print(f"'{table_name}' テーブルへのインポートが完了しました。{row_count}件")
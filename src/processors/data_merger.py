@@ -1,9 +1,72 @@
 import pandas as pd
+import numpy as np
+import itertools
 import os
+from contextlib import closing
 from datetime import date
 
 from ..database.connection import get_db_connection
 
+# 低カーディナリティの表示カラムはカテゴリ型で保持する（フィルター時の比較を整数コードで行うため）
+PRODUCTION_TYPES = ['内製', '外製', 'その他']
+COMPLIANCE_STATUSES = ['遵守', '未遵守', '未完成']
+PROGRESS_STATUSES = ['完了', '未完了']
+
+# 表示用データで 'YYYY-MM-DD' 形式の文字列として返す日付カラム
+DISPLAY_DATE_COLUMNS = ['所要日', '子指図計画開始日', '子指図計画終了日', '完了日', '基準計画終了日']
+
+# MRP管理者ごとの生産タイプ（ここにない管理者は「その他」）
+PRODUCTION_TYPE_BY_MANAGER = {
+    'PC1': '内製', 'PC2': '内製', 'PC3': '内製',
+    'PC4': '外製', 'PC5': '外製', 'PC6': '外製',
+}
+
+# 取込データの日付形式（推論を避けるため、日付変換では常に明示的に指定する）
+SOURCE_DATE_FORMAT = '%Y/%m/%d'
+# 履歴テーブルに保存する日時の形式
+HISTORY_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# PC対象のZP02オーダー（MRP管理者が'PC'で始まるもの）に、
+# ZP51Nのサマリー（子指図番号ごとに所要日が最も早い行）をLEFT JOINするクエリ
+# LIKEは大文字小文字を区別しないため、str.startswith と同じ判定になるGLOBで前方一致させる
+# 読み込むのは統合・表示・完了履歴の更新で使うカラムだけにする
+MERGED_ORDERS_QUERY = """
+    WITH s AS (
+        SELECT
+            "子指図番号", "所要日" AS "所要日_dt", "子MRP管理者", "工程(子)",
+            "親指図番号", "親品目コード", "親品目テキスト",
+            ROW_NUMBER() OVER (PARTITION BY "子指図番号" ORDER BY "所要日", rowid) AS rn
+        FROM zp51n
+        WHERE "子指図番号" IS NOT NULL AND "所要日" IS NOT NULL
+    )
+    SELECT z."指図番号", z."MRP管理者", z."品目コード", z."品目テキスト", z."指図ステータス", z."完成残数",
+           z."計画開始", z."計画終了", z."DLV日付",
+           s."所要日_dt", s."子MRP管理者", s."工程(子)", s."親指図番号", s."親品目コード", s."親品目テキスト"
+    FROM zp02 z
+    LEFT JOIN s ON z."指図番号" = s."子指図番号" AND s.rn = 1
+    WHERE z."MRP管理者" GLOB 'PC*'
+"""
+
+def _create_merge_indexes(conn):
+    """
+    JOINとサマリー化で使うキーにインデックスを作成する（取込でテーブルが作り直されるため毎回確認する）。
+    """
+    with conn:
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_zp02_ord ON zp02("指図番号")')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_zp02_mgr ON zp02("MRP管理者")')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_zp51n_ord ON zp51n("子指図番号", "所要日")')
+
+def format_date_strings(values):
+    """
+    datetime64型の日付を 'YYYY-MM-DD' 形式の文字列に変換する（欠損値はNone）。
+    日付は読み込み時に変換済みのため再変換はせず、dt.strftime の要素ごとのフォーマットも避けて
+    numpyの datetime64[D] 変換で一括処理する。
+    """
+    dates = pd.Series(values)
+    date_strings = dates.to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').astype(str).astype(object)
+    date_strings[dates.isna().to_numpy()] = None
+    return pd.Series(date_strings, index=dates.index)
+
 def update_plan_history(conn, df_zp02):
     """
     毎日の計画スナップショットを保存する。
@@ -22,42 +85,51 @@ def update_plan_history(conn, df_zp02):
                 PRIMARY KEY ("snapshot_date", "指図番号")
             )
         """)
+        # 完了履歴の基準計画終了日の集計で指図番号から引くためのインデックス
+        conn.execute(f'CREATE INDEX IF NOT EXISTS ix_plan_hist_ord ON {table_name}("指図番号")')
 
         # 今日の日付のスナップショットが既に存在するか確認
-        # Note: pandas.io.sql.DatabaseError will be raised if table does not exist.
-        try:
-            existing_today = pd.read_sql_query(
-                f"SELECT 1 FROM {table_name} WHERE snapshot_date = '{today_str}' LIMIT 1", conn
-            )
-            if not existing_today.empty:
-                print(f"{today_str} のスナップショットは既に存在するため、スキップします。")
-                return
-        except pd.io.sql.DatabaseError:
-             # テーブルが存在しない場合は、そのまま進む
-            pass
-
-
-        # 保存するスナップショットデータを作成
-        snapshot_df = df_zp02[['指図番号', '計画終了']].copy()
-        snapshot_df['snapshot_date'] = today_str
+        # テーブルは直前に作成済みのため、DataFrameを介さず1行だけ取得して判定する
+        existing_today = conn.execute(
+            f"SELECT 1 FROM {table_name} WHERE snapshot_date = ? LIMIT 1", (today_str,)
+        ).fetchone()
+        if existing_today:
+            print(f"{today_str} のスナップショットは既に存在するため、スキップします。")
+            return
 
-        # 型を変換
-        snapshot_df['計画終了'] = pd.to_datetime(snapshot_df['計画終了'], errors='coerce')
+        # 保存するスナップショットデータを作成（日時は履歴テーブルの形式の文字列、欠損値はNULLにする）
+        plan_end = pd.to_datetime(df_zp02['計画終了'], errors='coerce', format=SOURCE_DATE_FORMAT)
+        plan_end_strings = plan_end.dt.strftime(HISTORY_TIMESTAMP_FORMAT).to_numpy(dtype=object, na_value=None)
 
-        # データベースに書き込む
-        snapshot_df.to_sql(table_name, conn, if_exists='append', index=False)
-        print(f"{len(snapshot_df)}件の計画スナップショットを '{table_name}' に保存しました。")
+        # データベースに書き込む（to_sqlを経由せず、1トランザクションのexecutemanyで一括挿入する）
+        # 主キー (snapshot_date, 指図番号) が重複する行は挿入しない
+        with conn:
+            cursor = conn.executemany(
+                f'INSERT OR IGNORE INTO {table_name} ("snapshot_date", "指図番号", "計画終了") VALUES (?, ?, ?)',
+                zip(itertools.repeat(today_str), df_zp02['指図番号'], plan_end_strings)
+            )
+        print(f"{cursor.rowcount}件の計画スナップショットを '{table_name}' に保存しました。")
 
     except Exception as e:
         print(f"計画履歴の更新中にエラーが発生しました: {e}")
 
 
+# DB全体のスキーマバージョン（PRAGMA user_version に記録する）
+# user_version はDBファイルに1つだけのため、どのテーブルのマイグレーションを加えた場合もこの値を上げる
+DATABASE_SCHEMA_VERSION = 1
+
+# 遵守判定（完了日 <= 基準計画終了日）の生成カラム定義
+COMPLIANCE_COLUMN_DEFINITION = (
+    'INTEGER GENERATED ALWAYS AS (CASE WHEN date("完了日") <= date("基準計画終了日") THEN 1 ELSE 0 END) VIRTUAL'
+)
+
 def _add_column_if_not_exists(conn, table_name, column_name, column_type):
     """
     テーブルに指定されたカラムが存在しない場合、追加する。
     """
     cursor = conn.cursor()
-    cursor.execute(f"PRAGMA table_info({table_name})")
+    # 生成カラムは table_info に現れないため、table_xinfo で確認する
+    cursor.execute(f"PRAGMA table_xinfo({table_name})")
     columns = [row[1] for row in cursor.fetchall()]
     if column_name not in columns:
         print(f"'{table_name}'テーブルに'{column_name}'カラムを追加します...")
@@ -74,16 +146,28 @@ def update_completion_history(conn, merged_df):
     plan_table = "plan_history"
 
     try:
-        # 完了履歴テーブルが存在しない場合は作成
-        conn.execute(f"""
-            CREATE TABLE IF NOT EXISTS {completion_table} (
-                "子指図番号" TEXT PRIMARY KEY,
-                "完了日" TIMESTAMP
-            )
-        """)
-
-        # スキーママイグレーション：旧バージョンとの互換性のため、カラムが存在しない場合は追加
-        _add_column_if_not_exists(conn, completion_table, "基準計画終了日", "TIMESTAMP")
+        # テーブル作成とスキーママイグレーションは1つのトランザクションでまとめてコミットする
+        with conn:
+            conn.execute("BEGIN")
+            # 完了履歴テーブルが存在しない場合は最新のスキーマで作成
+            # （履歴のリセットなどでテーブルだけが削除された場合も、ここで作り直される）
+            # 遵守判定（完了日 <= 基準計画終了日）を生成カラムとして持ち、ダッシュボードの集計をDB側で行えるようにする
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {completion_table} (
+                    "子指図番号" TEXT PRIMARY KEY,
+                    "完了日" TIMESTAMP,
+                    "基準計画終了日" TIMESTAMP,
+                    "遵守" {COMPLIANCE_COLUMN_DEFINITION}
+                )
+            """)
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{completion_table}_completed ON {completion_table}("完了日")')
+
+            # スキーママイグレーション：旧バージョンで作成されたテーブルに、存在しないカラムを追加する
+            # 適用済みのスキーマバージョンをDBの user_version に記録し、適用済みならカラムの確認自体を省く
+            if conn.execute("PRAGMA user_version").fetchone()[0] < DATABASE_SCHEMA_VERSION:
+                _add_column_if_not_exists(conn, completion_table, "基準計画終了日", "TIMESTAMP")
+                _add_column_if_not_exists(conn, completion_table, "遵守", COMPLIANCE_COLUMN_DEFINITION)
+                conn.execute(f"PRAGMA user_version = {DATABASE_SCHEMA_VERSION}")
 
         # 完了したオーダー（DLV日付がある）を抽出
         completed_orders = merged_df[merged_df['DLV日付'].notna()].copy()
@@ -91,46 +175,55 @@ def update_completion_history(conn, merged_df):
             print("新規の完了オーダーはありませんでした。")
             return
 
-        # 既存の完了履歴を読み込み、既に処理済みのオーダーを除外
-        try:
-            existing_completed = pd.read_sql_query(f"SELECT \"子指図番号\" FROM {completion_table}", conn)
-            completed_orders = completed_orders[~completed_orders['指図番号'].isin(existing_completed['子指図番号'])]
-        except pd.io.sql.DatabaseError:
-            # テーブルがまだ存在しない場合は何もしない
-            pass
-
-        if completed_orders.empty:
-            print("保存済みの完了オーダー以外に、新規の完了オーダーはありませんでした。")
-            return
+        # 候補の照合から新規履歴の挿入までを1つのトランザクションで行い、コミットは最後に1回だけにする
+        with conn:
+            # 既に処理済みのオーダーを除外する
+            # 完了履歴全体は読み込まず、候補の指図番号を一時テーブルに入れて主キーのインデックスでDB側で照合する
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS _completion_candidates (id TEXT PRIMARY KEY)")
+            conn.execute("DELETE FROM _completion_candidates")
+            conn.executemany(
+                "INSERT OR IGNORE INTO _completion_candidates VALUES (?)",
+                ((order_number,) for order_number in completed_orders['指図番号'])
+            )
+            conn.execute(f'DELETE FROM _completion_candidates WHERE id IN (SELECT "子指図番号" FROM {completion_table})')
+            new_order_numbers = [row[0] for row in conn.execute("SELECT id FROM _completion_candidates")]
+            completed_orders = completed_orders[completed_orders['指図番号'].isin(new_order_numbers)]
 
-        # 計画履歴を読み込む
-        plan_history = pd.read_sql_query(f"SELECT * FROM {plan_table}", conn)
-        plan_history['計画終了'] = pd.to_datetime(plan_history['計画終了'])
-
-        # 各完了オーダーの基準計画終了日（最も古い計画終了日）を見つける
-        new_history_list = []
-        for index, order in completed_orders.iterrows():
-            order_number = order['指図番号']
-            order_plan_history = plan_history[plan_history['指図番号'] == order_number]
-
-            if not order_plan_history.empty:
-                baseline_plan_end = order_plan_history['計画終了'].min()
-                new_history_list.append({
-                    '子指図番号': order_number,
-                    '完了日': pd.to_datetime(order['DLV日付']),
-                    '基準計画終了日': baseline_plan_end
-                })
-
-        if not new_history_list:
-            print("新規完了オーダーに対応する計画履歴が見つかりませんでした。")
-            return
+            if completed_orders.empty:
+                print("保存済みの完了オーダー以外に、新規の完了オーダーはありませんでした。")
+                return
 
-        new_history_df = pd.DataFrame(new_history_list)
-        new_history_df.dropna(subset=['子指図番号', '完了日', '基準計画終了日'], inplace=True)
+            # 各完了オーダーの基準計画終了日（最も古い計画終了日）を、候補の指図番号に絞ってDB側で集計する
+            # 計画履歴全体は読み込まないため、メモリ使用量は新規完了オーダーの件数に比例する
+            baseline_plan_end = pd.read_sql_query(
+                f"""
+                    SELECT p."指図番号", MIN(p."計画終了") AS "計画終了"
+                    FROM {plan_table} p
+                    JOIN _completion_candidates c ON c.id = p."指図番号"
+                    GROUP BY p."指図番号"
+                """,
+                conn, index_col='指図番号', parse_dates={'計画終了': HISTORY_TIMESTAMP_FORMAT}
+            )['計画終了']
+            new_history_df = pd.DataFrame({
+                '子指図番号': completed_orders['指図番号'].to_numpy(),
+                '完了日': completed_orders['DLV日付'].to_numpy(),
+                '基準計画終了日': completed_orders['指図番号'].map(baseline_plan_end).to_numpy()
+            })
+            new_history_df.dropna(subset=['子指図番号', '完了日', '基準計画終了日'], inplace=True)
+
+            if new_history_df.empty:
+                print("新規完了オーダーに対応する計画履歴が見つかりませんでした。")
+                return
 
-        # 新規履歴をDBに追記
-        new_history_df.to_sql(completion_table, conn, if_exists='append', index=False)
-        print(f"{len(new_history_df)}件の新規完了履歴を保存しました。")
+            # 新規履歴をDBに追記（スキーマが固定のため、to_sqlを経由せずexecutemanyで一括挿入する）
+            # 主キー（子指図番号）が既に存在する行は挿入しない（同じ指図番号が複数行あっても全体は失敗させない）
+            for col in ['完了日', '基準計画終了日']:
+                new_history_df[col] = new_history_df[col].dt.strftime(HISTORY_TIMESTAMP_FORMAT)
+            cursor = conn.executemany(
+                f'INSERT OR IGNORE INTO {completion_table} ("子指図番号", "完了日", "基準計画終了日") VALUES (?, ?, ?)',
+                new_history_df[['子指図番号', '完了日', '基準計画終了日']].itertuples(index=False, name=None)
+            )
+            print(f"{cursor.rowcount}件の新規完了履歴を保存しました。")
 
     except Exception as e:
         print(f"完了履歴の更新中にエラーが発生しました: {e}")
@@ -144,106 +237,102 @@ def get_merged_data():
     print("データ統合処理を開始します...")
 
     try:
-        conn = get_db_connection()
-
-        # 1. データベースからテーブルを読み込む
-        df_zp02 = pd.read_sql_query("SELECT * FROM zp02", conn)
-        df_zp51n = pd.read_sql_query("SELECT * FROM zp51n", conn)
-        print(f"zp02: {len(df_zp02)}件, zp51n: {len(df_zp51n)}件 のデータを読み込みました。")
-
-        # 2. ZP02の全データに対して計画履歴を更新
-        update_plan_history(conn, df_zp02)
-
-        # 3. ZP02をPC対象でフィルタリング (これがマスターデータになる)
-        #    ZP02のMRP管理者を'PC'で始まるものでフィルタ
-        base_df = df_zp02[df_zp02['MRP管理者'].str.startswith('PC', na=False)].copy()
-        print(f"ZP02のPC対象オーダーをマスターデータとします。結果: {len(base_df)}件")
-
-        # 4. ZP51Nをサマリー化する (所要日の最小値を取得)
-        df_zp51n['所要日_dt'] = pd.to_datetime(df_zp51n['所要日'], errors='coerce')
-        zp51_summary = df_zp51n.dropna(subset=['所要日_dt', '子指図番号'])
-        # drop_duplicatesの前に、必要なカラムだけを選択しておく
-        zp51_summary = zp51_summary.sort_values('所要日_dt').drop_duplicates(
-            subset='子指図番号',
-            keep='first'
-        )[['子指図番号', '所要日_dt', '子MRP管理者', '工程(子)']] # 必要なカラムのみ
-        print(f"zp51nをサマリー化しました。結果: {len(zp51_summary)}件")
-
-        # 5. ZP02マスターにZP51NサマリーをLEFT JOIN
-        merged_df = pd.merge(
-            base_df,
-            zp51_summary,
-            left_on='指図番号',
-            right_on='子指図番号',
-            how='left'
-        )
-        print(f"PC対象のZP02マスターにZP51NサマリーをLEFT JOINしました。結果: {len(merged_df)}件")
-
-        # 6. 完了実績の履歴を更新 (JOIN後の全PCデータが対象)
-        update_completion_history(conn, merged_df)
-
-        # 7. 表示用のカラムを選択・整形する
-        final_df = pd.DataFrame()
-        final_df['親指図番号'] = merged_df['親指図番号']
-        final_df['親品目コード'] = merged_df['親品目コード']
-        final_df['親品目テキスト'] = merged_df['親品目テキスト']
-        final_df['子指図番号'] = merged_df['指図番号']
-        final_df['子品目コード'] = merged_df['品目コード']
-        final_df['子品目テキスト'] = merged_df['品目テキスト']
-        final_df['所要日'] = merged_df['所要日_dt'].dt.strftime('%Y-%m-%d').replace({pd.NaT: None})
-        final_df['子指図計画開始日'] = pd.to_datetime(merged_df['計画開始'], errors='coerce').dt.strftime('%Y-%m-%d').replace({pd.NaT: None})
-        final_df['子指図計画終了日'] = pd.to_datetime(merged_df['計画終了'], errors='coerce').dt.strftime('%Y-%m-%d').replace({pd.NaT: None})
-        final_df['計画数量'] = pd.to_numeric(merged_df['完成残数'], errors='coerce').fillna(0)
-        # ZP51Nに情報がない場合もZP02のMRP管理者を正とする
-        final_df['子MRP管理者'] = merged_df['子MRP管理者'].fillna(merged_df['MRP管理者'])
-
-        # [Req 3] 進捗フィールドの作成
-        final_df['進捗'] = merged_df['工程(子)'].apply(lambda x: '完了' if isinstance(x, str) and '○' in x else '未完了')
-
-        # [Req 2.2] 生産タイプを分類
-        def get_production_type(manager):
-            if isinstance(manager, str):
-                if manager in ['PC1', 'PC2', 'PC3']: return '内製'
-                if manager in ['PC4', 'PC5', 'PC6']: return '外製'
-            return 'その他'
-        final_df['生産タイプ'] = final_df['子MRP管理者'].apply(get_production_type)
-
-        # [Req 1] 遵守状況の計算
-        try:
-            completion_history = pd.read_sql_query("SELECT * FROM completion_history", conn)
-            completion_history['完了日'] = pd.to_datetime(completion_history['完了日'])
-            completion_history['基準計画終了日'] = pd.to_datetime(completion_history['基準計画終了日'])
-            final_df = pd.merge(final_df, completion_history, on='子指図番号', how='left')
-        except pd.io.sql.DatabaseError:
-            pass # テーブルがなければ何もしない
-
-        if '完了日' not in final_df.columns: final_df['完了日'] = pd.NaT
-        if '基準計画終了日' not in final_df.columns: final_df['基準計画終了日'] = pd.NaT
-
-        final_df['遵守状況'] = '未完成'
-        # DLVステータスを持つものを「完了」と判断する
-        completed_mask = merged_df['指図ステータス'].str.contains('DLV', na=False)
-        final_df.loc[completed_mask, '遵守状況'] = '未遵守'
-        final_df.loc[completed_mask & (final_df['完了日'] <= final_df['基準計画終了日']), '遵守状況'] = '遵守'
-
-        final_df['完了日'] = final_df['完了日'].dt.strftime('%Y-%m-%d').replace({pd.NaT: None})
-        final_df['基準計画終了日'] = final_df['基準計画終了日'].dt.strftime('%Y-%m-%d').replace({pd.NaT: None})
-
-        # 8. ソート順を適用
-        final_df = final_df.sort_values(
-            by=['所要日', '子MRP管理者', '子指図番号'],
-            ascending=[True, True, True],
-            na_position='last' # NaN値を末尾に
-        ).reset_index(drop=True)
-
-        final_df.insert(0, 'No', final_df.index + 1)
-        print("カラムの整形とソートが完了しました。")
-        return final_df
+        with closing(get_db_connection()) as conn:
+            _create_merge_indexes(conn)
+
+            # 1. 計画履歴の保存に必要なZP02のカラムだけを読み込み、全データに対して計画履歴を更新
+            df_plan = pd.read_sql_query('SELECT "指図番号", "計画終了" FROM zp02', conn)
+            print(f"zp02: {len(df_plan)}件 のデータを読み込みました。")
+            update_plan_history(conn, df_plan)
+
+            # 2. ZP02のPC対象でのフィルタリング（これがマスターデータになる）と、
+            #    ZP51Nのサマリー化（子指図番号ごとに所要日が最も早い行）およびLEFT JOINをSQLiteで行う
+            #    PC対象外の行はpandasに読み込まない
+            #    日付は 'YYYY/MM/DD' のゼロ埋め文字列なので、文字列の並び順がそのまま日付順になる
+            #    日付カラムはここで一度だけ形式を指定して変換し、以降の比較・表示ではこの変換結果を使う
+            merged_df = pd.read_sql_query(
+                MERGED_ORDERS_QUERY, conn,
+                parse_dates={col: SOURCE_DATE_FORMAT for col in ['所要日_dt', '計画開始', '計画終了', 'DLV日付']}
+            )
+            print(f"PC対象のZP02マスターにZP51NサマリーをLEFT JOINしました。結果: {len(merged_df)}件")
+
+            # 3. 完了実績の履歴を更新 (JOIN後の全PCデータが対象)
+            update_completion_history(conn, merged_df)
+
+            # 4. 表示用のカラムを選択・整形する
+            # ZP51Nに情報がない場合もZP02のMRP管理者を正とする
+            # 管理者の種類は少ないためカテゴリ型にし、ソートや生産タイプの対応付けを整数コードで行う
+            mrp_managers = merged_df['子MRP管理者'].fillna(merged_df['MRP管理者']).astype('category')
+
+            # [Req 3] 進捗フィールドの作成
+            #    SQLiteからの読み込み結果はobject型のため、Arrow文字列型に変換してArrowの部分文字列検索で判定する
+            process_done = merged_df['工程(子)'].astype('string[pyarrow]').str.contains('○', regex=False)
+            progress = pd.Categorical(np.where(
+                process_done.fillna(False).to_numpy(dtype=bool), '完了', '未完了'
+            ), categories=PROGRESS_STATUSES)
+
+            # [Req 2.2] 生産タイプを分類
+            production_types = pd.Categorical(
+                mrp_managers.map(PRODUCTION_TYPE_BY_MANAGER).astype(object).fillna('その他'), categories=PRODUCTION_TYPES
+            )
+
+            # カラムを1つずつ追加せず、1回のコンストラクタ呼び出しでまとめて作成する
+            final_df = pd.DataFrame({
+                '親指図番号': merged_df['親指図番号'],
+                '親品目コード': merged_df['親品目コード'],
+                '親品目テキスト': merged_df['親品目テキスト'],
+                '子指図番号': merged_df['指図番号'],
+                '子品目コード': merged_df['品目コード'],
+                '子品目テキスト': merged_df['品目テキスト'],
+                # 日付カラムは比較・ソートのため日付型のまま保持し、文字列への整形は最後にまとめて行う
+                '所要日': merged_df['所要日_dt'],
+                '子指図計画開始日': merged_df['計画開始'],
+                '子指図計画終了日': merged_df['計画終了'],
+                '計画数量': pd.to_numeric(merged_df['完成残数'], errors='coerce').fillna(0),
+                '子MRP管理者': mrp_managers,
+                '進捗': progress,
+                '生産タイプ': production_types,
+            }, copy=False)
+
+            # [Req 1] 遵守状況の計算
+            try:
+                # 日付は読み込み時に一度だけ変換し、遵守判定の比較と表示用の整形の両方で使う
+                # 子指図番号は完了履歴の主キーで一意なため、インデックスにして多対1の結合を行う
+                completion_history = pd.read_sql_query(
+                    'SELECT "子指図番号", "完了日", "基準計画終了日" FROM completion_history', conn,
+                    index_col='子指図番号', parse_dates={'完了日': HISTORY_TIMESTAMP_FORMAT, '基準計画終了日': HISTORY_TIMESTAMP_FORMAT}
+                )
+                final_df = final_df.join(completion_history, on='子指図番号', how='left', validate='m:1')
+            except pd.io.sql.DatabaseError:
+                pass # テーブルがなければ何もしない
+
+            if '完了日' not in final_df.columns: final_df['完了日'] = pd.NaT
+            if '基準計画終了日' not in final_df.columns: final_df['基準計画終了日'] = pd.NaT
+
+            # DLVステータスを持つものを「完了」と判断し、完了日が基準計画終了日以内なら「遵守」とする
+            #    判定はインデックスの整列を伴わないnumpy配列同士で行う（NaTとの比較はFalseになる）
+            completed = merged_df['指図ステータス'].str.contains('DLV', na=False).to_numpy(dtype=bool)
+            completed_at = final_df['完了日'].to_numpy(dtype='datetime64[ns]')
+            baseline_plan_end = final_df['基準計画終了日'].to_numpy(dtype='datetime64[ns]')
+            on_time = completed & (completed_at <= baseline_plan_end)
+            final_df['遵守状況'] = pd.Categorical(
+                np.select([on_time, completed], ['遵守', '未遵守'], default='未完成'), categories=COMPLIANCE_STATUSES
+            )
+
+            # 5. ソート順を適用
+            final_df = final_df.sort_values(
+                by=['所要日', '子MRP管理者', '子指図番号'],
+                ascending=[True, True, True],
+                na_position='last' # NaN値を末尾に
+            ).reset_index(drop=True)
+            # 遵守判定とソートを終えた後に、日付カラムを一度だけ表示用の文字列に整形する
+            for col in DISPLAY_DATE_COLUMNS:
+                final_df[col] = format_date_strings(final_df[col])
+
+            final_df.insert(0, 'No', final_df.index + 1)
+            print("カラムの整形とソートが完了しました。")
+            return final_df
 
     except Exception as e:
         print(f"データ統合中にエラーが発生しました: {e}")
         return pd.DataFrame()
-    finally:
-        if 'conn' in locals() and conn:
-            conn.close()
-            print("データベース接続を閉じました。")
@@ -20,6 +20,19 @@ LOCAL_DATA_PATHS = {
 # データベース設定
 DATABASE_PATH = os.path.join(BASE_DIR, 'data', 'production.db')
 
+# 統合済みデータの保存先（全セッションで共有するFeatherファイル）
+PLAN_DATA_PATH = os.path.join(BASE_DIR, 'data', 'plan.feather')
+
+# 接続時に設定するSQLiteのPRAGMA
+# WAL + synchronous=NORMAL でコミット毎のfsyncを減らし、一括書き込みを高速化する
+DATABASE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'cache_size': -65536,      # 64MB (負の値はKiB単位)
+    'mmap_size': 268435456,    # 256MB
+}
+
 # UI設定
 UI_CONFIG = {
     'title': '🏭 生産計画管理システム',